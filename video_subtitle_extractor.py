@@ -1,87 +1,236 @@
 import argparse
 import logging
 import os
+import functools
 import gc
 import time
 import multiprocessing
+import queue
+import threading
 from contextlib import contextmanager
 from dataclasses import dataclass
 from datetime import timedelta
-from typing import List, Tuple, Dict, Callable, Iterable
+from itertools import groupby
+from operator import attrgetter
+from typing import List, Tuple, Callable, Iterable, NamedTuple
 import psutil
 
+import av
 import cv2
-from fuzzywuzzy import fuzz
+import numpy as np
+from rapidfuzz import fuzz, process
 from tqdm import tqdm
 
 # Concurrent futures
-from concurrent.futures import ProcessPoolExecutor
-
-os.environ['OMP_NUM_THREADS'] = '1'
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, FIRST_COMPLETED, wait
 
 # ***** hardcode config *****
 # 字幕最长显示秒数
 subtitle_max_show_second = 10
 # 字幕相似度阈值(大于此阈值判定为相似)
 text_similar_threshold = 70
+# 批量处理时每个进程预留的CPU核数, 用于推算默认进程数
+ocr_worker_cpu_threads = 4
 
 logging.basicConfig(format='%(levelname)s: %(message)s', level=logging.INFO)
 
 
+def open_video(video_path: str):
+    try:
+        container = av.open(video_path)
+    except av.error.FFmpegError:
+        raise IOError(f'Can not open video {video_path}')
+    stream = container.streams.video[0]
+    # 多线程解码, thread_count=0 表示由FFmpeg自行决定线程数
+    stream.thread_type = 'AUTO'
+    stream.thread_count = 0
+    return container
+
+
 @contextmanager
 def capture_video(video_path: str) -> Callable:
-    vc = cv2.VideoCapture(video_path)
-    if not vc.isOpened():
-        raise IOError(f'Can not open video {video_path}')
+    container = open_video(video_path)
     try:
-        yield vc
+        yield container
     finally:
-        vc.release()
+        container.close()
+
+
+def _count_frames(container, stream) -> int:
+    """部分封装格式(如mkv)不记录总帧数, 此时按时长估算"""
+    if stream.frames:
+        return stream.frames
+    if stream.duration:
+        return int(stream.duration * stream.time_base * stream.average_rate)
+    return int((container.duration or 0) / av.time_base * stream.average_rate)
+
+
+@functools.lru_cache(maxsize=128)
+def _probe(video_path: str, mtime: int, size: int) -> Tuple[int, float, int, int]:
+    """读取视频的(总帧数, 帧率, 高, 宽). mtime和size只用作缓存的键, 文件变化后会重新读取"""
+    with capture_video(video_path) as container:
+        stream = container.streams.video[0]
+        return (_count_frames(container, stream), float(stream.average_rate),
+                stream.codec_context.height, stream.codec_context.width)
+
+
+def _frame_idx_of(frame, stream) -> int:
+    """根据帧的pts换算帧索引"""
+    return round((frame.pts - (stream.start_time or 0)) * stream.time_base * stream.average_rate)
+
+
+def _seek_frame(container, stream, frame_idx: int) -> None:
+    """跳转到帧索引之前(含)最近的关键帧"""
+    pts = int(frame_idx / stream.average_rate / stream.time_base) + (stream.start_time or 0)
+    container.seek(pts, stream=stream)
+
+
+class _GopTracker:
+    """根据解码出的关键帧实测关键帧间隔(GOP), 判断seek是否比顺序解码更划算"""
+
+    def __init__(self):
+        self.last_key = None  # 当前这段连续解码中最近的关键帧索引
+        self.gop_size = 0  # 实测的最大关键帧间隔, 连续解码到两个关键帧之前为0
+
+    def on_frame(self, frame, idx: int) -> None:
+        if not frame.key_frame:
+            return
+        if self.last_key is not None and idx > self.last_key:
+            self.gop_size = max(self.gop_size, idx - self.last_key)
+        self.last_key = idx
+
+    def on_seek(self) -> None:
+        # seek前后的两个关键帧之间隔着若干个GOP, 不能用来计算间隔
+        self.last_key = None
+
+    def should_seek(self, target: int, idx: int) -> bool:
+        """只有target距当前解码位置idx超过一个GOP, 且确定target之前(含)有一个位于idx之后的关键帧时才seek,
+        否则seek会倒回去重复解码, 或者为了跳过很少的几帧而频繁seek(如每帧都是关键帧的视频)"""
+        return (self.gop_size > 0 and self.last_key is not None
+                and target - idx > self.gop_size and target >= self.last_key + self.gop_size)
 
 
 def get_one_frame(video_path: str, pos: int):
-    with capture_video(video_path) as vc:
-        vc.set(cv2.CAP_PROP_POS_FRAMES, pos)
-        ret, frame = vc.read()
-        if not ret or frame is None:
-            raise AttributeError(f'read frame error. POS:{pos}')
-    return frame
+    with capture_video(video_path) as container:
+        stream = container.streams.video[0]
+        _seek_frame(container, stream, pos)
+        for frame in container.decode(stream):
+            if _frame_idx_of(frame, stream) >= pos:
+                return frame.to_ndarray(format='bgr24')
+    raise AttributeError(f'read frame error. POS:{pos}')
+
+
+class _SeekingReader:
+    """保持视频打开的单帧读取器: 目标帧在当前位置之后不远处时顺序解码, 否则才seek"""
+    max_forward: int = 250  # 顺序解码的最大距离, 超过则seek
+
+    def __init__(self, video_path: str):
+        self.video_path = video_path
+        self.current_pos = -1
+        self._frame = None
+        self._frames = None
+        self._container = open_video(video_path)
+        self._stream = self._container.streams.video[0]
+
+    def read(self, pos: int):
+        if pos == self.current_pos:
+            return self._frame
+        if self._frames is None or not 0 < pos - self.current_pos < self.max_forward:
+            _seek_frame(self._container, self._stream, pos)
+            self._frames = self._container.decode(self._stream)
+        for frame in self._frames:
+            idx = _frame_idx_of(frame, self._stream)
+            if idx >= pos:
+                self.current_pos = idx
+                self._frame = frame.to_ndarray(format='bgr24')
+                return self._frame
+        self._frames = None
+        raise AttributeError(f'read frame error. POS:{pos}')
+
+    def close(self) -> None:
+        self._container.close()
+
+
+def _to_image(frame, size: Tuple[int, int] = None):
+    """将解码出的帧转为BGR画面. 指定size(宽, 高)时在转换格式的同时缩放, 不必先输出原尺寸画面"""
+    if size is None:
+        return frame.to_ndarray(format='bgr24')
+    return frame.to_ndarray(width=size[0], height=size[1], format='bgr24', interpolation='AREA')
 
 
 # 接受一个帧索引迭代器,返回对应的每一帧画面
-def get_video_frames(video_path: str, frame_idx_iterator: Iterable = None) -> Iterable:
-    if frame_idx_iterator and (not isinstance(frame_idx_iterator, Iterable)):
+def get_video_frames(video_path: str, frame_idx_iterator: Iterable = None,
+                     target_size: Tuple[int, int] = None) -> Iterable:
+    if frame_idx_iterator is not None and (not isinstance(frame_idx_iterator, Iterable)):
         raise AttributeError("frame_idx_iterator must be Iterable")
 
-    with capture_video(video_path) as vc:
+    with capture_video(video_path) as container:
+        stream = container.streams.video[0]
         if frame_idx_iterator is None:
-            idx = 0
-            while True:
-                ret, frame = vc.read()
-                if not ret or frame is None:
+            for idx, frame in enumerate(container.decode(stream)):
+                yield idx, _to_image(frame, target_size)
+            return
+
+        if isinstance(frame_idx_iterator, np.ndarray):
+            frame_idx_iterator = frame_idx_iterator.tolist()
+        gop = _GopTracker()
+        frames = None
+        idx = -1
+        for target in frame_idx_iterator:
+            if target <= idx:  # 重复的索引, 或帧率不固定时已被跳过的索引
+                continue
+            if frames is None or gop.should_seek(target, idx):
+                _seek_frame(container, stream, target)
+                frames = container.decode(stream)
+                gop.on_seek()
+            for frame in frames:
+                idx = _frame_idx_of(frame, stream)
+                gop.on_frame(frame, idx)
+                if idx >= target:
+                    break
+            else:
+                return
+            yield idx, _to_image(frame, target_size)
+
+
+def prefetch(iterable: Iterable, maxsize: int = 4) -> Iterable:
+    """在后台线程中提前迭代(如解码视频帧), 使其与调用方的处理(如OCR)重叠执行"""
+    q = queue.Queue(maxsize=maxsize)
+    stop = threading.Event()
+    end = object()
+
+    def put(item) -> bool:
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((item, None)):
                     return
-                yield idx, frame
-                idx += 1
+        except BaseException as e:
+            put((end, e))
         else:
-            it = iter(frame_idx_iterator)
-            try:
-                idx = next(it)
-                target = idx
-                vc.set(cv2.CAP_PROP_POS_FRAMES, idx)
-                while True:
-                    if idx < target:
-                        ret = vc.grab()
-                        if not ret:
-                            return
-                        idx += 1
-                    else:
-                        ret, frame = vc.retrieve()
-                        if not ret or frame is None:
-                            return
-                        yield idx, frame
-                        target = next(it)
-            except StopIteration:
+            put((end, None))
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, error = q.get()
+            if error is not None:
+                raise error
+            if item is end:
                 return
+            yield item
+    finally:
+        stop.set()
+        thread.join()
 
 
 def convert_time_to_frame_idx(time_str: str, fps: int) -> int:
@@ -99,17 +248,29 @@ def convert_time_to_frame_idx(time_str: str, fps: int) -> int:
     return index
 
 
-@dataclass(frozen=True)
+# OcrResult、Subtitle会创建大量实例, 使用__slots__加普通__init__, 比frozen dataclass创建更快、占用更少
 class OcrResult:
+    __slots__ = ('box', 'text', 'score')
     box: List[List[int]]
     text: str
     score: int
 
+    def __init__(self, box: List[List[int]], text: str, score: int):
+        self.box = box
+        self.text = text
+        self.score = score
+
 
-@dataclass(frozen=True)
 class Subtitle(OcrResult):
+    __slots__ = ('frame_idx',)
     frame_idx: int
 
+    def __init__(self, box: List[List[int]], text: str, score: int, frame_idx: int):
+        self.box = box
+        self.text = text
+        self.score = score
+        self.frame_idx = frame_idx
+
     def __le__(self, other):
         return self.frame_idx <= other.frame_idx
 
@@ -119,45 +280,57 @@ class Subtitle(OcrResult):
     __repr__ = __str__
 
 
+class CleanedSubtitles(NamedTuple):
+    """去重后的字幕"""
+    frame_subs: List[List[Subtitle]]  # 每一帧的字幕
+    joined: List[str]  # 每一帧合并后的字幕文本
+
+
 class SubtitleOption:
     """字幕操作"""
     threshold: int = text_similar_threshold
 
     @classmethod
     def order_by_frame(cls, subtitles: List[Subtitle]) -> List[List[Subtitle]]:
-        keys: List[int] = []
-        sub_dict: Dict[int, List[Subtitle]] = dict()
-        group: List[List[Subtitle]] = []
+        # 识别结果本就按帧顺序产生, 对有序数据排序是O(N)的, 且排序稳定, 同一帧内的顺序不变
+        subtitles = sorted(subtitles, key=attrgetter('frame_idx'))
+        return [list(group) for _, group in groupby(subtitles, key=attrgetter('frame_idx'))]
 
-        for sub in subtitles:
-            if sub_dict.get(sub.frame_idx):
-                sub_dict[sub.frame_idx].append(sub)
+    @classmethod
+    def _kept_frames(cls, sub_order_by_frame: List[List[Subtitle]], joined: List[str]) -> List[int]:
+        """相似的相邻帧只保留平均分较高的一帧, 返回保留的帧在sub_order_by_frame中的下标"""
+        # 批量计算相邻两帧字幕的相似度. 单线程即可: 字符串很短, 且批量处理时每个进程的线程数是限定好的
+        scores = process.cpdist(joined[:-1], joined[1:], scorer=fuzz.ratio, score_cutoff=cls.threshold, workers=1)
+        kept = [0]
+        for i in range(1, len(sub_order_by_frame)):
+            keep = kept[-1]
+            # 保留的是上一帧时直接使用相邻帧的相似度, 否则与保留的字幕重新比较
+            if keep == i - 1:
+                similar = scores[i - 1] >= cls.threshold
             else:
-                sub_dict[sub.frame_idx] = [sub]
-            keys.append(sub.frame_idx)
-
-        for key in sorted(keys):
-            group.append(sub_dict[key])
-
-        return group
+                similar = cls.texts_similar(joined[i], joined[keep])
+            if not similar:
+                kept.append(i)
+            elif cls.choose_better(sub_order_by_frame[i], sub_order_by_frame[keep]) is sub_order_by_frame[i]:
+                kept[-1] = i
+        return kept
 
     @classmethod
-    def removed_similar(cls, sub_order_by_frame: List[List[Subtitle]]) -> List[List[Subtitle]]:
-        res = [sub_order_by_frame[0]]
-        for subs in sub_order_by_frame[1:]:
-            if not cls.subtitles_similar(subs, res[-1]):
-                res.append(subs)
-            else:
-                res[-1] = cls.choose_better(subs, res[-1])
-        return res
+    def removed_similar(cls, sub_order_by_frame: List[List[Subtitle]],
+                        joined: List[str] = None) -> List[List[Subtitle]]:
+        """:param joined: 每一帧合并后的字幕文本, 与sub_order_by_frame一一对应"""
+        if joined is None:
+            joined = [cls.join_text(subs) for subs in sub_order_by_frame]
+        return [sub_order_by_frame[i] for i in cls._kept_frames(sub_order_by_frame, joined)]
 
     @classmethod
-    def clean(cls, subtitles: List[Subtitle]) -> List[List[Subtitle]]:
+    def clean(cls, subtitles: List[Subtitle]) -> CleanedSubtitles:
         if not subtitles:
-            return []
+            return CleanedSubtitles([], [])
         frame_subs = cls.order_by_frame(subtitles)
-        frame_subs = cls.removed_similar(frame_subs)
-        return frame_subs
+        joined = [cls.join_text(subs) for subs in frame_subs]
+        kept = cls._kept_frames(frame_subs, joined)
+        return CleanedSubtitles([frame_subs[i] for i in kept], [joined[i] for i in kept])
 
     @classmethod
     def at_same_flame(cls, subs: List[Subtitle]) -> bool:
@@ -184,16 +357,27 @@ class SubtitleOption:
         s2 = cls.calc_avg_score(subs2)
         return subs1 if s1 > s2 else subs2
 
+    @classmethod
+    def join_text(cls, subs: List[Subtitle]) -> str:
+        """将同一帧的字幕合并为一句"""
+        return ' '.join([sub.text for sub in subs])
+
+    @classmethod
+    def texts_similar(cls, text1: str, text2: str) -> bool:
+        """两段字幕文本是否相似"""
+        # 低于score_cutoff时rapidfuzz会提前结束计算并返回0
+        return fuzz.ratio(text1, text2, score_cutoff=cls.threshold) >= cls.threshold
+
     @classmethod
     def subtitles_similar(cls, subs1: List[Subtitle], subs2: List[Subtitle]) -> bool:
         """两帧的字幕是否相似"""
-        text1 = ' '.join([sub.text for sub in subs1])
-        text2 = ' '.join([sub.text for sub in subs2])
-        return fuzz.ratio(text1, text2) >= cls.threshold
+        return cls.texts_similar(cls.join_text(subs1), cls.join_text(subs2))
 
 
 @dataclass(frozen=True)
 class SubtitleFormatter:
+    # 手动声明__slots__而非slots=True, 以兼容python3.10以下版本
+    __slots__ = ('content', 'start_time', 'end_time')
     content: str
     start_time: timedelta
     end_time: timedelta
@@ -230,40 +414,64 @@ class Video:
 
     def __init__(self, path: str):
         self.path = path
-        with capture_video(path) as v:
-            self.frame_count = int(v.get(cv2.CAP_PROP_FRAME_COUNT))
-            self.origin_fps = v.get(cv2.CAP_PROP_FPS)
-            self.fps = round(self.origin_fps)
-            self.height = int(v.get(cv2.CAP_PROP_FRAME_HEIGHT))
-            self.width = int(v.get(cv2.CAP_PROP_FRAME_WIDTH))
+        self._reader = None
+        stat = os.stat(path)
+        self.frame_count, self.origin_fps, self.height, self.width = _probe(path, stat.st_mtime_ns, stat.st_size)
+        self.fps = round(self.origin_fps)
+
+    def close(self) -> None:
+        """关闭read_frame保持打开的视频, 之后再读取时会重新打开"""
+        if self._reader is not None:
+            self._reader.close()
+            self._reader = None
+
+    def read_frame(self, pos: int):
+        """读取某一帧画面. 复用已打开的视频, 相邻的位置无需重新seek"""
+        if self._reader is None:
+            self._reader = _SeekingReader(self.path)
+        return self._reader.read(pos)
 
     def time_to_frame_idx(self, time_str: str) -> int:
         """获取某一时刻对应的帧索引"""
         return convert_time_to_frame_idx(time_str, self.fps)
 
-    def time_to_frame_idxes(self, time_start: str, time_end: str, capture_interval: float) -> Iterable:
-        """获取某一时间范围对应的帧索引集合"""
+    def _frame_range(self, time_start: str, time_end: str, capture_interval: float) -> Tuple[int, int, int]:
+        """获取某一时间范围对应的(起始帧, 结束帧, 步长)"""
         frame_start = 0 if not time_start else self.time_to_frame_idx(time_start)
         frame_end = self.frame_count - 1 if not time_end else self.time_to_frame_idx(time_end)
         if frame_end < frame_start:
             raise ValueError('time_start is later than time_end')
         step = 1 if not capture_interval else int(capture_interval * self.fps)
-        for frame_idx in range(frame_start, frame_end, step):
-            yield frame_idx
+        return frame_start, frame_end, step
+
+    def frame_indices(self, time_start: str, time_end: str, capture_interval: float) -> np.ndarray:
+        """获取某一时间范围对应的帧索引数组"""
+        frame_start, frame_end, step = self._frame_range(time_start, time_end, capture_interval)
+        return np.arange(frame_start, frame_end, step, dtype=np.int64)
+
+    def time_to_frame_idxes(self, time_start: str, time_end: str, capture_interval: float) -> Iterable:
+        """获取某一时间范围对应的帧索引集合"""
+        yield from self.frame_indices(time_start, time_end, capture_interval).tolist()
 
     def count_frame(self, time_start: str, time_end: str, capture_interval: float) -> int:
         """获取某段时间内共计多少帧"""
         indexes = self.time_to_frame_idxes(time_start, time_end, capture_interval)
         return sum(1 for _ in indexes)
 
-    def get_frames(self, frame_idx_iterator: Iterable = None) -> Iterable:
-        """输入帧索引集合, 获取每一帧对应的画面"""
-        return get_video_frames(self.path, frame_idx_iterator)
+    def count_frame_fast(self, time_start: str, time_end: str, capture_interval: float) -> int:
+        """获取某段时间内共计多少帧, 直接计算而不遍历帧索引"""
+        frame_start, frame_end, step = self._frame_range(time_start, time_end, capture_interval)
+        return (frame_end - frame_start + step - 1) // step
+
+    def get_frames(self, frame_idx_iterator: Iterable = None, target_size: Tuple[int, int] = None) -> Iterable:
+        """输入帧索引集合, 获取每一帧对应的画面. target_size(宽, 高)不为空时由解码器直接输出缩放后的画面"""
+        return get_video_frames(self.path, frame_idx_iterator, target_size)
 
-    def get_frames_by_time_range(self, time_start: str, time_end: str, capture_interval: float = 0.5) -> Iterable:
+    def get_frames_by_time_range(self, time_start: str, time_end: str, capture_interval: float = 0.5,
+                                 target_size: Tuple[int, int] = None) -> Iterable:
         """输入时间范围, 获取每一帧对应的画面"""
-        indexes = self.time_to_frame_idxes(time_start, time_end, capture_interval)
-        return self.get_frames(indexes)
+        indexes = self.frame_indices(time_start, time_end, capture_interval)
+        return self.get_frames(indexes, target_size)
 
     def get_frames_by_frame_range(self, frame_start: int, frame_end: int, frame_step: int) -> Iterable:
         """输入帧索引范围, 获取每一帧对应的画面"""
@@ -313,27 +521,32 @@ class Video:
         window_name = f'[{window_name}] press ESC/SPACE/ENTER to Exit, S to Save'
         tracker_name = 'Time'
 
+        seek_to = []  # 拖动进度条时记录目标秒数
+
         cv2.namedWindow(window_name, cv2.WINDOW_NORMAL | cv2.WINDOW_KEEPRATIO | cv2.WINDOW_GUI_EXPANDED)
-        with capture_video(self.path) as vc:
-            total_seconds = int(self.frame_count / self.fps)
-            if not start_frame:
-                vc.set(cv2.CAP_PROP_POS_FRAMES, start_frame)
-            cv2.createTrackbar(tracker_name, window_name, 0, total_seconds, lambda pos: vc.set(0, pos * 1000))
-            cv2.setTrackbarPos(tracker_name, window_name, int(start_frame / self.fps))
-            while True:
-                ret, frame = vc.read()
-                if not ret or frame is None:
-                    raise AttributeError(f'read frame error. POS:{vc.get(0)}')
-                if frame_handler:
-                    frame = frame_handler(frame, self)
-                cv2.imshow(window_name, frame)
-                cv2.setTrackbarPos(tracker_name, window_name, int(vc.get(0) / 1000))
-                key = cv2.waitKey(self.fps) & 0xFF
-                if key in [27, 32, 13]:  # esc、Space、Enter
-                    pos = cv2.getTrackbarPos(tracker_name, window_name)
-                    break
-                elif key == ord('s'):
-                    cv2.imwrite(f'{idx}.jpg', frame)
+        total_seconds = int(self.frame_count / self.fps)
+        idx = start_frame
+        cv2.createTrackbar(tracker_name, window_name, 0, total_seconds, seek_to.append)
+        cv2.setTrackbarPos(tracker_name, window_name, int(start_frame / self.fps))
+        while True:
+            if seek_to:
+                second = seek_to[-1]
+                seek_to.clear()
+                if second != int(idx / self.fps):
+                    idx = second * self.fps
+            frame = self.read_frame(idx)
+            idx = self._reader.current_pos
+            if frame_handler:
+                frame = frame_handler(frame, self)
+            cv2.imshow(window_name, frame)
+            cv2.setTrackbarPos(tracker_name, window_name, int(idx / self.fps))
+            key = cv2.waitKey(self.fps) & 0xFF
+            if key in [27, 32, 13]:  # esc、Space、Enter
+                pos = cv2.getTrackbarPos(tracker_name, window_name)
+                break
+            elif key == ord('s'):
+                cv2.imwrite(f'{idx}.jpg', frame)
+            idx += 1
         cv2.destroyAllWindows()
         return timedelta(seconds=pos)
 
@@ -345,7 +558,7 @@ class Video:
         window_name = f'[{window_name}] press SPACE/ENTER to Confirm'
         frame_index = 0 if not time_frame else self.time_to_frame_idx(time_frame)
         cv2.namedWindow(window_name, cv2.WINDOW_NORMAL | cv2.WINDOW_KEEPRATIO | cv2.WINDOW_GUI_EXPANDED)
-        frame = get_one_frame(self.path, frame_index)
+        frame = self.read_frame(frame_index)
         if frame_handler:
             frame = frame_handler(frame, self)
         roi = cv2.selectROI(window_name, frame, True, False)
@@ -360,7 +573,7 @@ class Video:
 
         cv2.namedWindow(window_name, cv2.WINDOW_NORMAL | cv2.WINDOW_KEEPRATIO | cv2.WINDOW_GUI_EXPANDED)
         frame_index = 0 if not time_frame else self.time_to_frame_idx(time_frame)
-        frame = get_one_frame(self.path, frame_index)
+        frame = self.read_frame(frame_index)
         if frame_handler:
             frame = frame_handler(frame, self)
 
@@ -387,33 +600,42 @@ class Video:
             raise AttributeError(f'supported file type:{file_type_list}, got {file_type}')
         return file_type
 
-    def save_subtitle(self, subtitles: str, file_type: str) -> None:
+    def _subtitle_path(self, file_type: str) -> str:
         basename = os.path.basename(self.path)
         file_name, file_ext = os.path.splitext(basename)
         # file_path = f'output/{file_name}.{file_type}'
         os.makedirs(os.path.join(os.path.dirname(self.path), 'output'), exist_ok=True)
-        file_path = os.path.join(os.path.dirname(self.path), 'output', f'{file_name}.{file_type}')
+        return os.path.join(os.path.dirname(self.path), 'output', f'{file_name}.{file_type}')
 
-        with open(file_path, "w", encoding='utf-8') as file:
+    def save_subtitle(self, subtitles: str, file_type: str) -> None:
+        with open(self._subtitle_path(file_type), "w", encoding='utf-8') as file:
             file.write(subtitles)
 
+    def save_subtitle_stream(self, subtitles: Iterable[str], file_type: str) -> None:
+        """逐条写入字幕(以换行分隔), 不在内存中拼接完整的字幕文本"""
+        with open(self._subtitle_path(file_type), "w", encoding='utf-8', buffering=1 << 20) as file:
+            for i, subtitle in enumerate(subtitles):
+                if i:
+                    file.write('\n')
+                file.write(subtitle)
+
     def save_subtitle_by_formatter(self, formatters: List[SubtitleFormatter], file_type: str = 'lrc') -> None:
         suffix = self._check_file_type(file_type)
-        subtitle_list = [getattr(formatter, suffix) for formatter in formatters]
-        content = '\n'.join(subtitle_list)
-        self.save_subtitle(content, file_type)
+        self.save_subtitle_stream((getattr(formatter, suffix) for formatter in formatters), file_type)
 
 
 class FrameHandler:
     @classmethod
-    def resize(cls, frame, video: Video, resize: float = 0.5):
+    def resize(cls, frame, video: Video, resize: float = 0.5, interpolation: int = cv2.INTER_LINEAR):
         if resize != 1:
             x, y = frame.shape[0:2]
-            frame = cv2.resize(frame, (int(y * resize), int(x * resize)))
+            frame = cv2.resize(frame, (int(y * resize), int(x * resize)), interpolation=interpolation)
         return frame
 
     @classmethod
     def gray(cls, frame, video: Video):
+        if frame.ndim == 2:  # 已经是灰度图
+            return frame
         return cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
 
     @classmethod
@@ -425,8 +647,10 @@ class FrameHandler:
     @classmethod
     def threshold(cls, frame, video: Video, threshold: int = 127):
         if threshold > 0:
-            frame = cls.gray(frame, video)
-            _, frame = cv2.threshold(frame, threshold, 255, cv2.THRESH_BINARY)
+            gray = cls.gray(frame, video)
+            # 灰度化生成的是新数组, 直接在其上二值化; 传入的本就是灰度图时不能改动它, 另行分配
+            dst = gray if gray is not frame else None
+            _, frame = cv2.threshold(gray, threshold, 255, cv2.THRESH_BINARY, dst=dst)
         return frame
 
 
@@ -453,16 +677,56 @@ class SubtitleExtractor:
         if ocr_result[0] is None:
             return []
 
-        return [
-            Subtitle(
-                box=res[0],
-                # remove chars that are obviously ocr errors
-                text=res[1][0].translate(self.table).strip(),
-                score=res[1][1],
-                frame_idx=frame_idx
-            )
-            for res in ocr_result[0]
-        ]
+        subtitles = []
+        for res in ocr_result[0]:
+            # remove chars that are obviously ocr errors
+            text = res[1][0].translate(self.table).strip()
+            if text:
+                subtitles.append(Subtitle(box=res[0], text=text, score=res[1][1], frame_idx=frame_idx))
+        return subtitles
+
+    def ocr_batch(self, ocr_handler, frames: List, frame_idxes: List[int]) -> List[Subtitle]:
+        """多帧一起识别: 逐帧检测文本框, 再把所有帧的文本框合并为一批进行识别"""
+        # PaddleOCR.ocr()在检测时不接受多张图, 因此直接调用其检测、分类、识别模型
+        return self._recognize_batch(ocr_handler, *self._detect_batch(ocr_handler, frames, frame_idxes))
+
+    @staticmethod
+    def _detect_batch(ocr_handler, frames: List, frame_idxes: List[int]) -> Tuple[List, List, List[int]]:
+        """逐帧检测文本框, 返回(文本框, 文本框对应的画面, 所属帧索引)"""
+        # 导入paddleocr时会把其目录加入sys.path, 之后才能导入tools
+        from tools.infer.predict_system import sorted_boxes
+        from tools.infer.utility import get_rotate_crop_image
+
+        boxes, crops, idxes = [], [], []
+        for frame, frame_idx in zip(frames, frame_idxes):
+            if frame.ndim == 2:  # 检测模型只接受BGR图像
+                frame = cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR)
+            dt_boxes, _ = ocr_handler.text_detector(frame)
+            if dt_boxes is None:
+                continue
+            for box in sorted_boxes(dt_boxes):
+                boxes.append(box)
+                crops.append(get_rotate_crop_image(frame, box))
+                idxes.append(frame_idx)
+        return boxes, crops, idxes
+
+    def _recognize_batch(self, ocr_handler, boxes: List, crops: List, idxes: List[int]) -> List[Subtitle]:
+        """对检测出的文本框做方向分类和文字识别"""
+        if not crops:
+            return []
+
+        if ocr_handler.use_angle_cls:
+            crops, _, _ = ocr_handler.text_classifier(crops)
+        rec_res, _ = ocr_handler.text_recognizer(crops)  # 按rec_batch_num分批识别
+        subtitles = []
+        for box, (text, score), frame_idx in zip(boxes, rec_res, idxes):
+            if score < ocr_handler.drop_score:
+                continue
+            # remove chars that are obviously ocr errors
+            text = text.translate(self.table).strip()
+            if text:
+                subtitles.append(Subtitle(box=box.tolist(), text=text, score=score, frame_idx=frame_idx))
+        return subtitles
 
     def _default_frame_handler(self, frame, video: Video):
         if self.frame_handler:
@@ -482,36 +746,37 @@ class SubtitleExtractor:
             window_name='reshow'
         )
 
-    def _to_formatter(self, subtitles: List[List[Subtitle]]) -> List[SubtitleFormatter]:
-        if not subtitles:
+    def _to_formatter(self, subtitles: CleanedSubtitles) -> List[SubtitleFormatter]:
+        if not isinstance(subtitles, CleanedSubtitles):
+            subtitles = CleanedSubtitles(subtitles, [SubtitleOption.join_text(subs) for subs in subtitles])
+        if not subtitles.frame_subs:
             raise AttributeError('len(subtitles) == 0')
 
         last_sub_alive = subtitle_max_show_second * self.video.fps  # 最后一句字幕默认持续10s
 
-        frame_idxes = [subs[0].frame_idx for subs in subtitles]
-        frame_idxes.append(subtitles[-1][0].frame_idx + last_sub_alive)
+        frame_idxes = np.fromiter((subs[0].frame_idx for subs in subtitles.frame_subs),
+                                  dtype=np.int64, count=len(subtitles.frame_subs))
+        # 下一个字幕开始帧减去当前字幕开始帧
+        alives = np.diff(frame_idxes, append=frame_idxes[-1] + last_sub_alive)
+        start_seconds = frame_idxes / self.video.origin_fps
+        end_seconds = np.minimum(start_seconds + subtitle_max_show_second,
+                                 (frame_idxes + alives) / self.video.origin_fps)
 
-        res = []
-        for frame_idx in range(0, len(subtitles)):
-            if not subtitles[frame_idx]:
-                continue
-
-            first_sub = subtitles[frame_idx][0]
-            alive = frame_idxes[frame_idx + 1] - frame_idxes[frame_idx]  # 下一个字幕开始帧减去当前字幕开始帧
-            start_second = first_sub.frame_idx / self.video.origin_fps
-            end_second = min(start_second + subtitle_max_show_second,
-                             (first_sub.frame_idx + alive) / self.video.origin_fps)
-            res.append(SubtitleFormatter(
-                content=' '.join([sub.text for sub in subtitles[frame_idx]]),  # 将同一帧的字幕都合并起来
+        return [
+            SubtitleFormatter(
+                content=content,  # 同一帧的字幕已经合并起来
                 start_time=timedelta(seconds=start_second),
                 end_time=timedelta(seconds=end_second)
-            ))
-        return res
+            )
+            for content, start_second, end_second in zip(subtitles.joined, start_seconds.tolist(),
+                                                         end_seconds.tolist())
+        ]
 
     def select_fragment(self, reshow: bool = False) -> None:
         times: List[timedelta] = [self.video.show(0, self._default_frame_handler, '(1/2) Select StartTime')]
         start = int(times[0].total_seconds() * self.video.fps)  # 第二次从前面结束的地方开始
         times.append(self.video.show(start, self._default_frame_handler, '(2/2) Select EndTime'))
+        self.video.close()
         self.time_start, self.time_end = [str(i) for i in sorted(times)]
         logging.info(f'[fragment] {self.time_start} -> {self.time_end}')
         if reshow:
@@ -520,12 +785,14 @@ class SubtitleExtractor:
     def select_roi(self, time_frame: str = '', reshow: bool = False) -> None:
         time_frame = time_frame if not time_frame else self.time_start
         self.roi_array = self.video.select_roi(time_frame=time_frame, frame_handler=self._default_frame_handler)
+        self.video.close()
         logging.info(f'[roi array] {self.roi_array}')
         if reshow:
             self._show()
 
     def select_threshold(self, time_frame: str = '', reshow: bool = False) -> None:
         self.threshold = self.video.select_threshold(time_frame=time_frame, frame_handler=self._default_frame_handler)
+        self.video.close()
         logging.info(f'[threshold] {self.threshold}')
         if reshow:
             self._show()
@@ -536,18 +803,54 @@ class SubtitleExtractor:
                         time_start: str = '',
                         time_end: str = '',
                         capture_interval: float = 0.5,
-                        ) -> List[List[Subtitle]]:
+                        batch_size: int = 16,
+                        pipeline: bool = False,
+                        target_size: Tuple[int, int] = None,
+                        ) -> CleanedSubtitles:
+        """:param pipeline: 为True时检测与识别流水线执行: 当前线程检测下一批的同时, 另一个线程识别上一批
+        :param target_size: (宽, 高), 不为空时由解码器直接输出该尺寸的画面
+        """
+        self.video.close()  # 交互选择时打开的视频在识别期间用不到
+        video_frames = self.video.get_frames_by_time_range(time_start, time_end, capture_interval, target_size)
+        if frame_handler is not None:
+            video_frames = ((idx, frame_handler(frame, self.video)) for idx, frame in video_frames)
+
         subtitles = []
+        frames, idxes = [], []  # 攒够batch_size帧后一起识别
         # 非部署版本的paddleOCR不可同时识别多张图,是线程不安全的:https://aistudio.baidu.com/paddle/forum/topic/show/989282
-        for idx, frame in tqdm(
-                iterable=self.video.get_frames_by_time_range(time_start, time_end, capture_interval),
-                total=self.video.count_frame(time_start, time_end, capture_interval),
-                unit='帧'):
-            if frame_handler:
-                frame = frame_handler(frame, self.video)
-            if frame is not None:
-                subtitle = self.ocr(ocr_handler, frame, idx)
-                subtitles.extend(subtitle)
+        # 因此每个模型同一时刻只在一个线程中使用: 检测模型只在当前线程, 分类和识别模型只在rec_executor的线程中
+        # 解码与frame_handler放到后台线程中与之重叠执行
+        rec_executor = ThreadPoolExecutor(max_workers=1) if pipeline else None
+        pending = None  # 正在识别的上一批
+
+        def recognize(batch_frames, batch_idxes):
+            nonlocal pending
+            if rec_executor is None:
+                subtitles.extend(self.ocr_batch(ocr_handler, batch_frames, batch_idxes))
+                return
+            detected = self._detect_batch(ocr_handler, batch_frames, batch_idxes)
+            if pending is not None:
+                subtitles.extend(pending.result())
+            pending = rec_executor.submit(self._recognize_batch, ocr_handler, *detected)
+
+        try:
+            for idx, frame in tqdm(
+                    iterable=prefetch(video_frames),
+                    total=self.video.count_frame_fast(time_start, time_end, capture_interval),
+                    unit='帧'):
+                if frame is not None:
+                    frames.append(frame)
+                    idxes.append(idx)
+                if len(frames) >= batch_size:
+                    recognize(frames, idxes)
+                    frames, idxes = [], []
+            if frames:
+                recognize(frames, idxes)
+            if pending is not None:
+                subtitles.extend(pending.result())
+        finally:
+            if rec_executor is not None:
+                rec_executor.shutdown()
         subs = SubtitleOption.clean(subtitles)
         return subs
 
@@ -571,20 +874,33 @@ class SubtitleExtractor:
             # handle frame config
             gray: bool = False,
             resize: float = 1,
-    ) -> List[List[Subtitle]]:
+    ) -> CleanedSubtitles:
+        # 没有自定义frame_handler时由解码器直接输出缩放后的画面, ROI按同样的比例缩放
+        roi_array = self.roi_array
+        decode_size = None
+        if resize != 1 and not self.frame_handler:
+            decode_size = (int(self.video.width * resize), int(self.video.height * resize))
+            roi_array = tuple(i * resize for i in self.roi_array)
+        need_resize = resize != 1 and decode_size is None
+
         def frame_handler(frame, video: Video):
             if self.frame_handler:
                 frame = self.frame_handler(frame, video)
-            if self.roi_array:
-                frame = FrameHandler.roi(frame, video, self.roi_array)
-            if gray:
-                frame = FrameHandler.gray(frame, video)
+            # 先裁剪(切片视图, 不复制)再缩小, 灰度化和二值化都只处理缩小后的画面
+            if roi_array:
+                frame = FrameHandler.roi(frame, video, roi_array)
+            if need_resize:
+                frame = FrameHandler.resize(frame, video, resize, interpolation=cv2.INTER_AREA)
             if self.threshold != -1:
+                # 会先灰度化, 灰度图是新分配的才原地二值化, 不会改动自定义frame_handler返回的数组
                 frame = FrameHandler.threshold(frame, video, threshold=127)
-            if resize != 1:
-                frame = FrameHandler.resize(frame, video, resize)
+            elif gray:
+                frame = FrameHandler.gray(frame, video)
             return frame
 
+        if not (self.frame_handler or roi_array or gray or self.threshold != -1 or need_resize):
+            frame_handler = None  # 画面无需任何处理, 省去每一帧的函数调用
+
         from paddleocr import PaddleOCR, paddleocr  # 因为PaddleOCR需要加载大量数据到内存中，延迟导入
         paddleocr.logging.disable(logging.DEBUG)
         paddleocr.logging.disable(logging.WARNING)
@@ -596,16 +912,30 @@ class SubtitleExtractor:
             frame_handler=frame_handler,
             time_start=time_start if time_start else self.time_start,
             time_end=time_end if time_end else self.time_end,
-            capture_interval=capture_interval
+            capture_interval=capture_interval,
+            batch_size=rec_batch_num,
+            # GPU识别时检测与识别流水线执行, 一个模型在做CPU端的前后处理时另一个模型可以使用GPU
+            pipeline=use_gpu,
+            target_size=decode_size
         )
         return subtitles
 
-    def save(self, subtitles: List[List[Subtitle]], file_type: str = 'lrc') -> None:
+    def save(self, subtitles: CleanedSubtitles, file_type: str = 'lrc') -> None:
         formatters = self._to_formatter(subtitles)
         self.video.save_subtitle_by_formatter(formatters, file_type)
         logging.info(f'{file_type} subtitle file has generated')
 
 
+def _limit_threads() -> None:
+    """限制OpenMP/MKL/OpenCV的线程数, 避免多个进程同时运行时线程数远超CPU核数.
+    PaddleOCR是延迟导入的, 因此只要在extract之前调用即可生效
+    """
+    os.environ['OMP_NUM_THREADS'] = '1'
+    os.environ['MKL_NUM_THREADS'] = '1'
+    cv2.setNumThreads(1)
+    cv2.ocl.setUseOpenCL(False)
+
+
 def _parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument('--path', type=str, help='video path')
@@ -667,6 +997,7 @@ def _parse_args():
 
 
 def cmd_run() -> None:
+    _limit_threads()
     args = _parse_args()
     extractor = SubtitleExtractor(video_path=args.path)
     if args.use_fragment:
@@ -734,12 +1065,12 @@ video_info = {
 }
 
 
-def process_video(video_path):
+def process_video(video_path, cpu_threads: int = 24):
     path = video_path[0]
     roi = video_info[video_path[1]]
     print(f"begin: {path}")
     extractor = SubtitleExtractor(video_path=path, roi_array=roi)
-    subtitles = extractor.extract(lang='ch', resize=0.5)
+    subtitles = extractor.extract(lang='ch', resize=0.5, cpu_threads=cpu_threads)
     extractor.save(subtitles, file_type='txt')
     print(f"Processed: {path}")
 
@@ -752,7 +1083,7 @@ def check_memory_usage():
         gc.collect()
 
 
-def process_all_videos(file_type="txt"):
+def process_all_videos(file_type="txt", max_workers: int = 0):
     assets_dir = '/root/autodl-tmp/progress/'
     video_files = []
 
@@ -763,17 +1094,28 @@ def process_all_videos(file_type="txt"):
                 if not has_output_file(video_path, file_type):
                     video_files.append([video_path, root.split('/')[-2]])
 
-    # 分批处理，每批 100 个视频
-    batch_size = 100
+    # 每个进程都会加载一份PaddleOCR模型, 进程数必须有上限, 否则内存会耗尽
     num_cores = multiprocessing.cpu_count()
-
-    for i in range(0, len(video_files), batch_size):
-        batch = video_files[i:i + batch_size]
-        with ProcessPoolExecutor(max_workers=num_cores) as executor:
-            executor.map(process_video, batch)
-
-        check_memory_usage()
-        gc.collect()
+    max_workers = max_workers or max(1, num_cores // ocr_worker_cpu_threads)
+    # 各进程平分CPU, 避免OCR线程总数超过核数
+    cpu_threads = max(1, num_cores // max_workers)
+
+    def collect(futures):
+        for future in futures:
+            path = running.pop(future)
+            if future.exception():
+                logging.error(f'process {path} failed: {future.exception()!r}')
+
+    running = {}
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=_limit_threads) as executor:
+        for video_file in video_files:
+            # 同时最多提交max_workers个视频, 内存占用过高时暂停提交
+            if len(running) >= max_workers:
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                collect(done)
+            check_memory_usage()
+            running[executor.submit(process_video, video_file, cpu_threads)] = video_file[0]
+        collect(wait(running).done)
 
 
 if __name__ == '__main__':